@@ -0,0 +1,206 @@
+import argparse
+import json
+import random
+import textwrap
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from statistics import mean
+from typing import ClassVar
+
+import requests
+from langchain_core.messages.base import BaseMessage
+from langchain_core.messages.human import HumanMessage
+
+from utils import (
+    SUMMARIZER_AGENT_SYSTEM_PROMPT,
+    SUMMARIZER_SYSTEM_PROMPT,
+    build_formatter_messages,
+    build_summarizer_messages,
+)
+
+parser = argparse.ArgumentParser(
+    description="Compare prefill cost per paper between the old single-message prompt layout and the current system-prefix layout"
+)
+parser.add_argument(
+    "--ollama-api-base-url",
+    help="URL to Ollama API. Defaults to a built-in mock endpoint that simulates prefix caching",
+    type=str,
+    default=None,
+    required=False,
+)
+parser.add_argument(
+    "--summarizer-llm-name",
+    help="Name of Ollama model who digests the paper into a summary. Defaults to qwen3:8b",
+    type=str,
+    default="qwen3:8b",
+    required=False,
+)
+parser.add_argument(
+    "--formatter-llm-name",
+    help="Name of Ollama model who converts a sumamry into the predefined JSON format. Defaults to gemma3:4b",
+    type=str,
+    default="gemma3:4b",
+    required=False,
+)
+parser.add_argument(
+    "--num-papers",
+    help="Number of synthetic papers to run through. Defaults to 10",
+    type=int,
+    default=10,
+    required=False,
+)
+parser.add_argument(
+    "--summarizer-as-agent",
+    help="Use the prompt given to the summarizer when it runs as an agent.",
+    action="store_true",
+    required=False,
+)
+
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    """Minimal /api/chat that keeps the last prompt of each model as its "KV cache".
+
+    Whitespace-separated words stand in for tokens, and only the tokens after
+    the longest common prefix with the previous prompt are counted as evaluated.
+    """
+
+    cache: ClassVar[dict[str, list[str]]] = {}
+    lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        tokens = " ".join(
+            f"<|{m['role']}|> {m['content']}" for m in body["messages"]
+        ).split()
+        with self.lock:
+            cached = self.cache.get(body["model"], [])
+            n_reused = 0
+            for a, b in zip(cached, tokens):
+                if a != b:
+                    break
+                n_reused += 1
+            self.cache[body["model"]] = tokens
+        prompt_eval_count = len(tokens) - n_reused
+        payload = json.dumps(
+            {
+                "model": body["model"],
+                "message": {"role": "assistant", "content": ""},
+                "done": True,
+                "prompt_eval_count": prompt_eval_count,
+                "prompt_eval_duration": prompt_eval_count * 1_000_000,  # 1ms per token
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args) -> None:
+        pass  # keep the benchmark output clean
+
+
+def build_legacy_summarizer_messages(
+    title: str, abstract: str, summarizer_as_agent: bool
+) -> list[BaseMessage]:
+    # the layout used before the prompts were split into a system prefix and a per-paper tail
+    system_prompt = (
+        SUMMARIZER_AGENT_SYSTEM_PROMPT
+        if summarizer_as_agent
+        else SUMMARIZER_SYSTEM_PROMPT
+    )
+    instructions, _, agent_suffix = system_prompt.partition("\n\nYou can use tools")
+    text = instructions + textwrap.dedent(f"""
+
+        ```
+        [Paper Information]
+        title: {title}
+        abstract: {abstract}
+        ```""")
+    if agent_suffix:
+        text += "\nYou can use tools" + agent_suffix
+    return [HumanMessage(text)]
+
+
+def build_legacy_formatter_messages(summary: str) -> list[BaseMessage]:
+    system_message, human_message = build_formatter_messages(summary=summary)
+    return [HumanMessage(f"{system_message.content}\n\n{human_message.content}")]
+
+
+def prefill(
+    base_url: str, model: str, messages: list[BaseMessage]
+) -> tuple[int, float]:
+    r = requests.post(
+        url=f"{base_url}/api/chat",
+        json={
+            "model": model,
+            "messages": [
+                {
+                    "role": "system" if m.type == "system" else "user",
+                    "content": m.content,
+                }
+                for m in messages
+            ],
+            "stream": False,
+            "keep_alive": "30m",
+            "options": {"num_predict": 1},  # only the prefill is of interest here
+        },
+        timeout=600,
+    )
+    r.raise_for_status()
+    data = r.json()
+    return data.get("prompt_eval_count", 0), data.get("prompt_eval_duration", 0) / 1e6
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.ollama_api_base_url
+    if base_url is None:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), MockOllamaHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    rng = random.Random(0)
+    vocabulary = "model data learning graph network training robust efficient sparse attention benchmark".split()
+    papers = [
+        (
+            f"Paper {i}: " + " ".join(rng.choices(vocabulary, k=8)),
+            " ".join(rng.choices(vocabulary, k=200)),
+            " ".join(rng.choices(vocabulary, k=250)),  # stands in for the summary
+        )
+        for i in range(args.num_papers)
+    ]
+
+    for layout, summarizer_messages, formatter_messages in [
+        ("before", build_legacy_summarizer_messages, build_legacy_formatter_messages),
+        ("after", build_summarizer_messages, build_formatter_messages),
+    ]:
+        MockOllamaHandler.cache.clear()
+        counts, durations = [], []
+        for title, abstract, summary in papers:
+            # the summarizer and the formatter alternate, just as in process_results
+            s_count, s_duration = prefill(
+                base_url,
+                args.summarizer_llm_name,
+                summarizer_messages(
+                    title=title,
+                    abstract=abstract,
+                    summarizer_as_agent=args.summarizer_as_agent,
+                ),
+            )
+            f_count, f_duration = prefill(
+                base_url, args.formatter_llm_name, formatter_messages(summary=summary)
+            )
+            counts.append(s_count + f_count)
+            durations.append(s_duration + f_duration)
+        # the first paper always pays for the full prompt, so report the warm ones separately
+        print(
+            f"{layout:>6}: prompt_eval_count/paper={mean(counts):.0f} "
+            f"(warm {mean(counts[1:] or counts):.0f}), "
+            f"prefill ms/paper={mean(durations):.1f} (warm {mean(durations[1:] or durations):.1f})"
+        )
+
+    if server is not None:
+        server.shutdown()
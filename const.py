@@ -5,7 +5,7 @@ from typing import Final, Optional
 import requests
 from fake_useragent import UserAgent
 from pydantic import BaseModel, Field, field_validator
-from requests.exceptions import Timeout
+from requests.exceptions import RequestException
 
 ARXIV_CATEGORIES: Final[set[str]] = {
     # includes Computer Science and Electrical Engineering and Systems Science group
@@ -114,7 +114,8 @@ class PaperGist(BaseModel):
                     allow_redirects=True,
                     headers=REQUEST_HEADERS,
                 )
-            except Timeout:
+            except RequestException:
+                # e.g. timeouts, or hosts made up by the LLM that don't resolve
                 logging.warning(
                     f"{url.url} is an inaccessible url, being removed from reference urls"
                 )
@@ -131,6 +132,17 @@ class PaperGist(BaseModel):
         return sanitized_urls
 
 
+class PaperCandidate(BaseModel):
+    # only the fields of arxiv.Result used downstream, so that full results need not be kept in memory
+    title: str
+    abstract: str
+    author: str
+    url: str
+    pdf_url: Optional[str]
+    journal_ref: Optional[str]
+    published: datetime
+
+
 class Paper(BaseModel):
     title: str
     author: str
@@ -0,0 +1,269 @@
+import os
+import threading
+import time
+from logging import Logger
+from typing import Optional
+
+from pydantic import BaseModel, PrivateAttr
+from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry.builtin_handlers import (
+    ConnectionErrorRetryHandler,
+    ServerErrorRetryHandler,
+)
+from slack_sdk.http_retry.request import HttpRequest
+from slack_sdk.http_retry.response import HttpResponse
+from slack_sdk.http_retry.state import RetryState
+from slack_sdk.models.blocks import Block
+from slack_sdk.web import WebClient
+
+from const import Paper, PaperList
+
+
+class RateLimiter:
+    """Keep at least `interval` seconds between consecutive calls to `wait`."""
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self._last_call = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            delay = self._last_call + self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._last_call = time.monotonic()
+
+
+class ChannelLedger(BaseModel):
+    parent_ts: Optional[str] = None
+    posted_urls: list[str] = []
+
+
+class DeliveryLedger(BaseModel):
+    """What has already been delivered for a category and date, persisted after every step
+    so that a rerun resumes where the last one stopped instead of posting everything again."""
+
+    file_ids: dict[str, str] = {}
+    channels: dict[str, ChannelLedger] = {}
+
+    _path: str = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @classmethod
+    def load(cls, path: str) -> "DeliveryLedger":
+        if os.path.exists(path):
+            with open(path) as ledgerfile:
+                ledger = cls.model_validate_json(ledgerfile.read())
+        else:
+            ledger = cls()
+        ledger._path = path
+        return ledger
+
+    def channel(self, channel_id: str) -> ChannelLedger:
+        with self._lock:
+            return self.channels.setdefault(channel_id, ChannelLedger())
+
+    def record_file(self, path: str, file_id: str) -> None:
+        with self._lock:
+            self.file_ids[path] = file_id
+            self._save()
+
+    def record_parent(self, channel_id: str, ts: str) -> None:
+        with self._lock:
+            self.channels[channel_id].parent_ts = ts
+            self._save()
+
+    def record_post(self, channel_id: str, url: str) -> None:
+        with self._lock:
+            self.channels[channel_id].posted_urls.append(url)
+            self._save()
+
+    def _save(self) -> None:
+        # write to a temporary file first so that a crash never leaves a broken ledger behind
+        with open(f"{self._path}.tmp", "w") as ledgerfile:
+            ledgerfile.write(self.model_dump_json(indent=2))
+        os.replace(f"{self._path}.tmp", self._path)
+
+
+class ChannelDeliveryReport(BaseModel):
+    channel_id: str
+    parent_ts: Optional[str] = None
+    already_posted: int = 0
+    posted: int = 0
+    posted_without_image: int = 0
+    elapsed_seconds: float = 0.0
+    error: Optional[str] = None
+
+
+class SkipPostMessageMixin:
+    """Never retry chat.postMessage, because the message may have been posted even though
+    the response was lost or an error was returned, and a retry would duplicate it."""
+
+    def _can_retry(
+        self,
+        *,
+        state: RetryState,
+        request: HttpRequest,
+        response: Optional[HttpResponse] = None,
+        error: Optional[Exception] = None,
+    ) -> bool:
+        if request.url.endswith("/chat.postMessage"):
+            return False
+        return super()._can_retry(  # type: ignore
+            state=state, request=request, response=response, error=error
+        )
+
+
+class ConnectionErrorRetryHandlerExceptPosts(
+    SkipPostMessageMixin, ConnectionErrorRetryHandler
+):
+    pass
+
+
+class ServerErrorRetryHandlerExceptPosts(SkipPostMessageMixin, ServerErrorRetryHandler):
+    pass
+
+
+def wait_for_file(
+    client: WebClient, file_id: str, timeout: float, logger: Logger
+) -> None:
+    """Wait until Slack finishes processing an uploaded image, which is when it gets thumbnails.
+
+    Referencing the file before that results in "invalid slack file" errors.
+    """
+    deadline = time.monotonic() + timeout
+    interval = 1.0
+    while time.monotonic() < deadline:
+        try:
+            file = client.files_info(file=file_id).data["file"]  # type:ignore
+        except SlackApiError as e:
+            # e.g. the token lacks the files:read scope. fall back to a fixed wait
+            logger.warning(f"failed to check the status of {file_id}: {e}")
+            time.sleep(min(10, max(deadline - time.monotonic(), 0)))
+            return
+        if any(key.startswith("thumb_") for key in file):
+            return
+        time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+        interval *= 2
+    logger.warning(f"{file_id} is still being processed after {timeout}s")
+
+
+def upload_figures(
+    client: WebClient,
+    paper_list: PaperList,
+    ledger: DeliveryLedger,
+    logger: Logger,
+) -> dict[str, str]:
+    """Upload each figure once and return a map from its path to the Slack file ID.
+
+    Uploaded files are not shared to any channel, so the same file ID can be
+    referenced from image blocks in every channel of the workspace. Figures
+    already recorded in the ledger are not uploaded again, and figures that
+    fail to upload are left out of the map.
+    """
+    for paper in paper_list.papers:
+        path = paper.first_figure_path
+        if not path or path in ledger.file_ids:
+            continue
+        try:
+            # 0 byte image sometimes appears, so filter it out here
+            if os.path.getsize(path) == 0:
+                continue
+            with open(path, "rb") as imagefile:
+                fileupload_resp = client.files_upload_v2(
+                    filename=os.path.basename(path),
+                    content=imagefile.read(),
+                )
+        except (SlackApiError, OSError) as e:
+            # e.g. an invalid or oversized file. the paper is posted without the image
+            logger.error(f"failed to upload {path}, sending the paper without it: {e}")
+            continue
+        file_id = fileupload_resp.data["file"]["id"]  # type:ignore
+        wait_for_file(client=client, file_id=file_id, timeout=30, logger=logger)
+        ledger.record_file(path=path, file_id=file_id)
+        logger.info(f"uploaded {path} as {file_id}")
+    return ledger.file_ids
+
+
+def is_invalid_image_error(e: SlackApiError) -> bool:
+    # a broken or unprocessed image is reported as invalid_blocks ("[ERROR] invalid slack file" in the details).
+    # the blocks are otherwise the same for every paper, so this error points at the image
+    return e.response.get("error") == "invalid_blocks"
+
+
+def build_parent_message(paper_list: PaperList) -> str:
+    parent_msg = f"*The last {len(paper_list.papers)} papers of those submitted on {paper_list.date.strftime('%Y-%m-%d')} (UTC)*\n"
+    for idx, paper in enumerate(paper_list.papers):
+        parent_msg += f"{idx + 1}. {paper.title}\n"
+    return parent_msg
+
+
+def post_to_channel(
+    client: WebClient,
+    channel_id: str,
+    parent_msg: str,
+    paper_blocks: list[tuple[Paper, list[Block], Optional[list[Block]]]],
+    ledger: DeliveryLedger,
+    interval: float,
+    logger: Logger,
+) -> ChannelDeliveryReport:
+    """Post the parent message and a threaded reply for each paper to a single channel.
+
+    `paper_blocks` holds, for each paper, its blocks and the blocks to fall back on
+    when the image is rejected (None when the paper has no image). Messages already
+    recorded in the ledger are skipped, and the rest are recorded as they are posted.
+    """
+    report = ChannelDeliveryReport(channel_id=channel_id)
+    channel_ledger = ledger.channel(channel_id)
+    rate_limiter = RateLimiter(interval=interval)
+    started_at = time.perf_counter()
+    try:
+        if channel_ledger.parent_ts is None:
+            rate_limiter.wait()
+            slack_resp = client.chat_postMessage(
+                channel=channel_id, text=parent_msg, mrkdwn=True
+            )
+            ledger.record_parent(channel_id=channel_id, ts=slack_resp.data["ts"])  # type:ignore
+        else:
+            logger.info(
+                f"resuming the thread {channel_ledger.parent_ts} in {channel_id}"
+            )
+        report.parent_ts = channel_ledger.parent_ts
+
+        # send detail of each paper to a thread dangling from the parent message
+        for paper, blocks, blocks_without_image in paper_blocks:
+            if paper.url in channel_ledger.posted_urls:
+                report.already_posted += 1
+                continue
+            rate_limiter.wait()
+            try:
+                client.chat_postMessage(
+                    text=f"summary of {paper.title}",
+                    channel=channel_id,
+                    blocks=blocks,
+                    thread_ts=report.parent_ts,
+                )
+                ledger.record_post(channel_id=channel_id, url=paper.url)
+                report.posted += 1
+                continue
+            except SlackApiError as e:
+                if blocks_without_image is None or not is_invalid_image_error(e):
+                    raise
+            # the image was rejected, so remove it from the block and try to send again
+            rate_limiter.wait()
+            client.chat_postMessage(
+                text=f"summary of {paper.title}",
+                channel=channel_id,
+                blocks=blocks_without_image,
+                thread_ts=report.parent_ts,
+            )
+            ledger.record_post(channel_id=channel_id, url=paper.url)
+            report.posted_without_image += 1
+    except (SlackApiError, OSError) as e:
+        # OSError covers network errors (e.g. URLError) left after the retries.
+        # stop here to keep the papers in order in the thread. a rerun resumes from this point
+        logger.error(f"stopped posting to {channel_id}: {e}")
+        report.error = str(e)
+    report.elapsed_seconds = time.perf_counter() - started_at
+    return report
@@ -54,6 +54,13 @@ parser.add_argument(
     action="store_true",
     required=False,
 )
+parser.add_argument(
+    "--max-reasoning-tokens",
+    help="Max number of reasoning tokens the summarizer may generate per paper before it is asked to write the summary right away. Defaults to 2048",
+    type=int,
+    default=2048,
+    required=False,
+)
 parser.add_argument(
     "--formatter-llm-name",
     help="Name of Ollama model who converts a sumamry into the predefined JSON format. Defaults to gemma3:4b",
@@ -61,6 +68,28 @@ parser.add_argument(
     default="gemma3:4b",
     required=False,
 )
+parser.add_argument(
+    "--fallback-formatter-llm-names",
+    help="Names of Ollama models to fall back on, in this order, when the formatter keeps failing. Defaults to none",
+    type=str,
+    nargs="*",
+    default=[],
+    required=False,
+)
+parser.add_argument(
+    "--formatter-max-attempts",
+    help="Max number of attempts per formatter model, with validation errors fed back. Defaults to 2",
+    type=int,
+    default=2,
+    required=False,
+)
+parser.add_argument(
+    "--formatter-reliability-target",
+    help="Success rate below which a formatter model is skipped in favor of the fallbacks. Defaults to 0.9",
+    type=float,
+    default=0.9,
+    required=False,
+)
 parser.add_argument(
     "--ollama-api-base-url",
     help="URL to Ollama API. Defaults to http://127.0.0.1:11434",
@@ -68,6 +97,19 @@ parser.add_argument(
     default="http://127.0.0.1:11434",
     required=False,
 )
+parser.add_argument(
+    "--keep-alive",
+    help="How long Ollama keeps the models loaded after each request (e.g. 10m, 1h). Defaults to 30m",
+    type=str,
+    default="30m",
+    required=False,
+)
+parser.add_argument(
+    "--pin-models",
+    help="Keep both the summarizer and the formatter loaded indefinitely, overriding --keep-alive.",
+    action="store_true",
+    required=False,
+)
 parser.add_argument(
     "--verbose",
     help="Enable verbose logging from this script.",
@@ -91,9 +133,19 @@ if __name__ == "__main__":
     # instantiate LLMs
     summarizer, formatter = prepare_llms(
         summarizer_llm_name=args.summarizer_llm_name,
-        formatter_llm_name=args.formatter_llm_name,
+        formatter_llm_names=[
+            args.formatter_llm_name,
+            *args.fallback_formatter_llm_names,
+        ],
         ollama_api_base_url=args.ollama_api_base_url,
         summarizer_as_agent=args.summarizer_as_agent,
+        keep_alive=-1
+        if args.pin_models
+        else args.keep_alive,  # negative value means "forever"
+        formatter_max_attempts=args.formatter_max_attempts,
+        formatter_reliability_target=args.formatter_reliability_target,
+        formatter_stats_path=os.path.join(args.data_dir, "formatter-stats.json"),
+        logger=logger,
         debug=False,
     )
 
@@ -112,8 +164,10 @@ if __name__ == "__main__":
         summarizer=summarizer,
         formatter=formatter,
         data_dir=args.data_dir,
+        max_reasoning_tokens=args.max_reasoning_tokens,
         logger=logger,
     )
+    formatter.log_stats()
 
     # write to json
     with open(
@@ -1,19 +1,75 @@
+import json
+import os
 import re
+import time
+from logging import Logger
+from typing import ClassVar, Final, Optional
 
 import requests
 from bs4 import BeautifulSoup, Comment
+from httpx import TransportError
 from langchain_community.tools import DuckDuckGoSearchResults
-from langchain_core.language_models.base import LanguageModelInput
-from langchain_core.runnables.base import Runnable
+from langchain_core.messages.ai import AIMessage
+from langchain_core.messages.base import BaseMessage
+from langchain_core.messages.human import HumanMessage
 from langchain_core.tools import tool
 from langchain_ollama import ChatOllama
 from langgraph.graph.graph import CompiledGraph
 from langgraph.prebuilt import create_react_agent
-from pydantic import BaseModel, Field
+from ollama import ResponseError
+from pydantic import BaseModel, Field, ValidationError
 
 from const import REQUEST_HEADERS, PaperGist
 
 
+class ReasoningFilter:
+    """Incrementally strip <think>...</think> blocks from streamed LLM output.
+
+    Tags may be split across chunks, so a possible partial tag at the end of
+    the buffer is held back until the next chunk arrives.
+    """
+
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self) -> None:
+        self._buffer = ""
+        self.in_reasoning = False
+
+    def feed(self, text: str) -> str:
+        """Consume a chunk and return the part of it that belongs to the answer."""
+        self._buffer += text
+        answer_parts = []
+        while True:
+            tag = self.CLOSE_TAG if self.in_reasoning else self.OPEN_TAG
+            idx = self._buffer.find(tag)
+            if idx == -1:
+                # hold back the longest suffix that could be the beginning of the tag
+                keep = next(
+                    (
+                        n
+                        for n in range(min(len(tag) - 1, len(self._buffer)), 0, -1)
+                        if tag.startswith(self._buffer[-n:])
+                    ),
+                    0,
+                )
+                emit_until = len(self._buffer) - keep
+                if not self.in_reasoning:
+                    answer_parts.append(self._buffer[:emit_until])
+                self._buffer = self._buffer[emit_until:]
+                break
+            if not self.in_reasoning:
+                answer_parts.append(self._buffer[:idx])
+            self._buffer = self._buffer[idx + len(tag) :]
+            self.in_reasoning = not self.in_reasoning
+        return "".join(answer_parts)
+
+    def flush(self) -> str:
+        """Return whatever answer text is still held back at the end of the stream."""
+        remaining, self._buffer = self._buffer, ""
+        return "" if self.in_reasoning else remaining
+
+
 class FetchContentAtURLInput(BaseModel):
     url: str = Field(description="The HTTP or HTTPS URL to fetch content from")
 
@@ -83,17 +139,269 @@ def fetch_content_at_url(
             return decoded_text
 
 
+def repair_json(text: str) -> str:
+    """Fix the usual ways small LLMs break JSON: code fences, surrounding prose,
+    trailing commas and output truncated by num_predict."""
+    text = re.sub(r"^\s*```(?:json)?|```\s*$", "", text.strip()).strip()
+    text = text[max(text.find("{"), 0) :]
+
+    # scan the object, dropping anything after it, dropping trailing commas outside strings
+    # and closing whatever is still open at the end
+    repaired: list[str] = []
+    closers: list[str] = []
+    in_string = escaped = False
+
+    def drop_trailing_comma() -> None:
+        while repaired and repaired[-1].isspace():
+            repaired.pop()
+        if repaired and repaired[-1] == ",":
+            repaired.pop()
+
+    for c in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in "{[":
+            closers.append("}" if c == "{" else "]")
+        elif c in "}]" and closers:
+            drop_trailing_comma()
+            repaired.append(closers.pop())
+            if not closers:
+                break
+            continue
+        repaired.append(c)
+    if in_string:
+        repaired.append('"')
+    for closer in reversed(closers):
+        drop_trailing_comma()
+        repaired.append(closer)
+    return "".join(repaired)
+
+
+def parse_paper_gist(text: str) -> tuple[PaperGist, bool]:
+    """Validate the formatter's output, repairing the JSON locally if needed.
+
+    Returns the gist and whether a local repair was necessary.
+    """
+    try:
+        return PaperGist.model_validate_json(text), False
+    except ValidationError as e:
+        if not any(err["type"] == "json_invalid" for err in e.errors()):
+            raise  # the JSON itself is fine, some fields are not
+    return PaperGist.model_validate_json(repair_json(text)), True
+
+
+def describe_format_error(e: Exception) -> str:
+    if isinstance(e, ValidationError):
+        return "\n".join(
+            f"- {'.'.join(map(str, err['loc'])) or 'output'}: {err['msg']}"
+            for err in e.errors()
+        )
+    return f"- {type(e).__name__}: {e}"
+
+
+class FormatterStats(BaseModel):
+    calls: int = 0
+    successes: int = 0
+    attempts: int = 0
+    locally_repaired: int = 0
+    # exponentially decayed counterparts of calls and successes, so that a model's
+    # reliability is judged by its recent behavior rather than its whole history
+    recent_calls: float = 0.0
+    recent_successes: float = 0.0
+
+    RECENT_DECAY: ClassVar[float] = 0.95
+
+    def record(self, success: bool) -> None:
+        self.calls += 1
+        self.recent_calls = self.recent_calls * self.RECENT_DECAY + 1
+        self.recent_successes *= self.RECENT_DECAY
+        if success:
+            self.successes += 1
+            self.recent_successes += 1
+
+    @property
+    def success_rate(self) -> float:
+        return self.successes / self.calls if self.calls else 1.0
+
+    @property
+    def recent_success_rate(self) -> float:
+        return self.recent_successes / self.recent_calls if self.recent_calls else 1.0
+
+    @property
+    def retry_rate(self) -> float:
+        # extra attempts per call, beyond the first one
+        return (self.attempts - self.calls) / self.calls if self.calls else 0.0
+
+
+class FormatterWithRecovery:
+    """Format a summary into a PaperGist, recovering from broken structured output.
+
+    Each formatter (ordered from the cheapest) first gets its output repaired
+    locally, then is retried with the validation error fed back, and finally
+    the next formatter is tried. Success and retry rates of each model are
+    persisted so that unreliable models can be skipped in later runs. Skipped
+    models are still tried every `REPROBE_INTERVAL` calls, so that they can
+    earn their place back.
+    """
+
+    MIN_CALLS_TO_JUDGE: Final[int] = 10
+    REPROBE_INTERVAL: Final[int] = 10
+
+    def __init__(
+        self,
+        formatters: list[ChatOllama],
+        max_attempts: int,
+        reliability_target: float,
+        stats_path: Optional[str],
+        logger: Logger,
+    ) -> None:
+        self.formatters = formatters
+        self.max_attempts = max_attempts
+        self.reliability_target = reliability_target
+        self.stats_path = stats_path
+        self.logger = logger
+        self.num_invocations = 0
+        self.stats: dict[str, FormatterStats] = {}
+        if stats_path and os.path.exists(stats_path):
+            with open(stats_path) as statsfile:
+                self.stats = {
+                    model: FormatterStats.model_validate(stats)
+                    for model, stats in json.load(statsfile).items()
+                }
+
+    def is_reliable(self, model: str) -> bool:
+        stats = self.stats.get(model, FormatterStats())
+        return (
+            stats.calls < self.MIN_CALLS_TO_JUDGE
+            or stats.recent_success_rate >= self.reliability_target
+        )
+
+    def cheapest_reliable_model(self) -> str:
+        return next(
+            (f.model for f in self.formatters if self.is_reliable(f.model)),
+            self.formatters[-1].model,
+        )
+
+    def invoke(self, input: list[BaseMessage]) -> PaperGist:
+        # skip formatters known to miss the reliability target, except when re-probing them.
+        # the last resort is always kept
+        self.num_invocations += 1
+        reprobe = self.num_invocations % self.REPROBE_INTERVAL == 0
+        candidates = [
+            f for f in self.formatters[:-1] if reprobe or self.is_reliable(f.model)
+        ] + self.formatters[-1:]
+        last_error: Optional[Exception] = None
+        try:
+            for formatter in candidates:
+                stats = self.stats.setdefault(formatter.model, FormatterStats())
+                answered = False
+                messages = list(input)
+                for attempt in range(1, self.max_attempts + 1):
+                    try:
+                        output = str(formatter.invoke(input=messages).content)
+                    except (TransportError, ConnectionError) as e:
+                        # Ollama is unreachable or overloaded, so wait before trying again.
+                        # note that the ollama client turns httpx.ConnectError into the built-in ConnectionError
+                        last_error = e
+                        self.logger.warning(
+                            f"{formatter.model} is unreachable ({e}), retrying in {2**attempt}s"
+                        )
+                        time.sleep(2**attempt)
+                        continue
+                    except ResponseError as e:
+                        last_error = e
+                        if e.status_code >= 500:
+                            self.logger.warning(
+                                f"{formatter.model} failed with {e}, retrying in {2**attempt}s"
+                            )
+                            time.sleep(2**attempt)
+                            continue
+                        break  # e.g. the model is not pulled, retrying won't help
+                    # only attempts the model actually answered tell about its reliability
+                    answered = True
+                    stats.attempts += 1
+                    try:
+                        paper_gist, repaired = parse_paper_gist(output)
+                    except Exception as e:
+                        # feed the errors back so that the model can fix only the broken fields.
+                        # any other error raised while validating also counts as a failed attempt
+                        last_error = e
+                        self.logger.info(
+                            f"output of {formatter.model} was invalid (attempt {attempt}/{self.max_attempts}): "
+                            + (
+                                f"{e.error_count()} errors"
+                                if isinstance(e, ValidationError)
+                                else f"{type(e).__name__}: {e}"
+                            )
+                        )
+                        messages = [
+                            *input,
+                            AIMessage(output),
+                            HumanMessage(
+                                "Your output did not match the specified format because of the following errors:\n"
+                                + describe_format_error(e)
+                                + "\nOutput the whole JSON again with these errors fixed, keeping the valid fields as they are."
+                            ),
+                        ]
+                        continue
+                    stats.record(success=True)
+                    if repaired:
+                        stats.locally_repaired += 1
+                        self.logger.info(f"repaired the output of {formatter.model}")
+                    return paper_gist
+                if answered:
+                    stats.record(success=False)
+                self.logger.warning(f"{formatter.model} failed to format the summary")
+            raise RuntimeError(
+                "every formatter failed to format the summary"
+            ) from last_error
+        finally:
+            self.save_stats()
+
+    def save_stats(self) -> None:
+        if self.stats_path:
+            with open(self.stats_path, "w") as statsfile:
+                json.dump(
+                    {model: stats.model_dump() for model, stats in self.stats.items()},
+                    statsfile,
+                )
+
+    def log_stats(self) -> None:
+        for model, stats in self.stats.items():
+            self.logger.info(
+                f"{model}: success rate {stats.success_rate:.0%} over {stats.calls} calls "
+                f"({stats.recent_success_rate:.0%} recently), "
+                f"{stats.retry_rate:.2f} retries per call, {stats.locally_repaired} locally repaired"
+            )
+        self.logger.info(
+            f"cheapest formatter meeting the reliability target of {self.reliability_target:.0%}: {self.cheapest_reliable_model()}"
+        )
+
+
 def prepare_llms(
     summarizer_llm_name: str,
-    formatter_llm_name: str,
+    formatter_llm_names: list[str],
     summarizer_as_agent: bool,
     ollama_api_base_url: str,
+    keep_alive: int | str,
+    formatter_max_attempts: int,
+    formatter_reliability_target: float,
+    formatter_stats_path: Optional[str],
+    logger: Logger,
     debug: bool,
-) -> tuple[CompiledGraph | ChatOllama, Runnable[LanguageModelInput, PaperGist]]:
+) -> tuple[CompiledGraph | ChatOllama, FormatterWithRecovery]:
     summarizer = ChatOllama(
         model=summarizer_llm_name,
         num_ctx=10240,  # sufficiently large context to utilize both user's input and tool's output for reasoning
         num_predict=3072,
+        keep_alive=keep_alive,  # keep the model (and the KV cache of the shared prompt prefix) loaded between papers
         base_url=ollama_api_base_url,
         verbose=debug,
     )
@@ -105,15 +413,22 @@ def prepare_llms(
             debug=debug,
         )
 
-    formatter = (
-        ChatOllama(
-            model=formatter_llm_name,
-            num_predict=1024,
-            temperature=0.1,
-            base_url=ollama_api_base_url,
-            verbose=debug,
-        )
-        .with_structured_output(PaperGist, method="json_schema")
-        .with_retry(stop_after_attempt=5)
+    formatter = FormatterWithRecovery(
+        formatters=[
+            ChatOllama(
+                model=formatter_llm_name,
+                num_predict=1024,
+                temperature=0.1,
+                format=PaperGist.model_json_schema(),  # same as with_structured_output(method="json_schema"), but keeps the raw text for repairing
+                keep_alive=keep_alive,
+                base_url=ollama_api_base_url,
+                verbose=debug,
+            )
+            for formatter_llm_name in formatter_llm_names
+        ],
+        max_attempts=formatter_max_attempts,
+        reliability_target=formatter_reliability_target,
+        stats_path=formatter_stats_path,
+        logger=logger,
     )
     return summarizer, formatter  # type: ignore
@@ -1,15 +1,27 @@
 import argparse
+import json
 import logging
 import os
 import sys
-import time
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
-from slack_sdk.errors import SlackApiError
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
+from slack_sdk.http_retry.builtin_interval_calculators import (
+    BackoffRetryIntervalCalculator,
+)
 from slack_sdk.web import WebClient
 
 from block import get_paper_block
 from const import ARXIV_CATEGORIES, PaperList
+from delivery import (
+    ConnectionErrorRetryHandlerExceptPosts,
+    DeliveryLedger,
+    ServerErrorRetryHandlerExceptPosts,
+    build_parent_message,
+    post_to_channel,
+    upload_figures,
+)
 
 parser = argparse.ArgumentParser(
     description="Send information of the latest papers to Slack"
@@ -22,7 +34,8 @@ parser.add_argument(
 )
 parser.add_argument(
     "--channel-id",
-    help="ID of the Slack channel to send to",
+    help="ID of the Slack channel to send to. Multiple IDs can be given to send to several channels at once",
+    nargs="+",
     required=True,
 )
 parser.add_argument(
@@ -31,6 +44,13 @@ parser.add_argument(
     default=os.path.join(os.path.dirname(__file__), "data"),
     required=False,
 )
+parser.add_argument(
+    "--post-interval",
+    help="Minimum interval in seconds between posts to the same channel. Defaults to 1",
+    type=float,
+    default=1.0,
+    required=False,
+)
 parser.add_argument(
     "--verbose",
     help="Enable verbose logging from this script",
@@ -52,8 +72,22 @@ if __name__ == "__main__":
     else:
         logger.setLevel(logging.WARNING)
 
-    # create Slack client
-    client = WebClient(token=os.environ["SLACK_API_TOKEN"])
+    # create Slack client, which waits as long as Retry-After tells when rate limited
+    # and backs off exponentially on connection and server errors (except for posts, which may duplicate)
+    client = WebClient(
+        token=os.environ["SLACK_API_TOKEN"],
+        retry_handlers=[
+            ConnectionErrorRetryHandlerExceptPosts(
+                max_retry_count=3,
+                interval_calculator=BackoffRetryIntervalCalculator(backoff_factor=1.0),
+            ),
+            ServerErrorRetryHandlerExceptPosts(
+                max_retry_count=3,
+                interval_calculator=BackoffRetryIntervalCalculator(backoff_factor=1.0),
+            ),
+            RateLimitErrorRetryHandler(max_retry_count=5),
+        ],
+    )
 
     # load paperlist from json
     with open(os.path.join(args.data_dir, f"papers-{args.category}.json")) as jsonfile:
@@ -63,42 +97,64 @@ if __name__ == "__main__":
         # No paper appeared on that day
         sys.exit()
 
-    # build parent message and send it
-    paper_titles = list(map(lambda x: x.title, paper_list.papers))
-    parent_msg = f"*The last {len(paper_titles)} papers of those submitted on {paper_list.date.strftime('%Y-%m-%d')} (UTC)*\n"
-    for idx, title in enumerate(paper_titles):
-        parent_msg += f"{idx + 1}. {title}\n"
-    slack_resp = client.chat_postMessage(
-        channel=args.channel_id, text=parent_msg, mrkdwn=True
+    # load what has already been delivered, so that a rerun resumes where the last one stopped
+    ledger = DeliveryLedger.load(
+        os.path.join(
+            args.data_dir,
+            f"ledger-{args.category}-{paper_list.date.strftime('%Y-%m-%d')}.json",
+        )
     )
 
-    # send detail of each paper to a thread dangling from the parent message
+    # upload every figure once and build every block once, to be shared by all channels
+    file_ids = upload_figures(
+        client=client, paper_list=paper_list, ledger=ledger, logger=logger
+    )
+    paper_blocks = []
     for paper in paper_list.papers:
-        # 0 byte image sometimes appears, so filter it out here
-        if paper.first_figure_path and os.path.getsize(paper.first_figure_path) > 0:
-            with open(paper.first_figure_path, "rb") as imagefile:
-                fileupload_resp = client.files_upload_v2(
-                    filename=os.path.basename(paper.first_figure_path),
-                    content=imagefile.read(),
-                )
-                time.sleep(10)  # IMPORTANT: wait for the upload to complete!
-            image_fileid = fileupload_resp.data["file"]["id"]  # type:ignore
-        else:
-            image_fileid = None
-        try:
-            client.chat_postMessage(
-                text=f"summary of {paper.title}",
-                channel=args.channel_id,
-                blocks=get_paper_block(paper=paper, image_fileid=image_fileid),
-                thread_ts=slack_resp.data["ts"],  # type:ignore
+        image_fileid = (
+            file_ids.get(paper.first_figure_path) if paper.first_figure_path else None
+        )
+        paper_blocks.append(
+            (
+                paper,
+                get_paper_block(paper=paper, image_fileid=image_fileid),
+                get_paper_block(paper=paper, image_fileid=None)
+                if image_fileid
+                else None,
             )
-        except SlackApiError:
-            # some image files lead to "[ERROR] invalid slack file" error.
-            # In that case, remove the image from the block and try to send again
-            client.chat_postMessage(
-                text=f"summary of {paper.title}",
-                channel=args.channel_id,
-                blocks=get_paper_block(paper=paper, image_fileid=None),
-                thread_ts=slack_resp.data["ts"],  # type:ignore
+        )
+    parent_msg = build_parent_message(paper_list=paper_list)
+
+    # post to all channels concurrently, each with its own rate limit
+    channel_ids = list(dict.fromkeys(args.channel_id))  # drop duplicates, keeping order
+    with ThreadPoolExecutor(max_workers=len(channel_ids)) as executor:
+        reports = list(
+            executor.map(
+                lambda channel_id: post_to_channel(
+                    client=client,
+                    channel_id=channel_id,
+                    parent_msg=parent_msg,
+                    paper_blocks=paper_blocks,
+                    ledger=ledger,
+                    interval=args.post_interval,
+                    logger=logger,
+                ),
+                channel_ids,
             )
-        time.sleep(1)  # sleep for 1 second
+        )
+
+    # report how the delivery went for each channel
+    for report in reports:
+        logger.log(
+            logging.WARNING if report.error else logging.INFO,
+            f"{report.channel_id}: {report.already_posted + report.posted + report.posted_without_image}/{len(paper_list.papers)} papers delivered "
+            f"({report.already_posted} in earlier runs, {report.posted_without_image} without image) "
+            f"in {report.elapsed_seconds:.1f}s"
+            + (f", error: {report.error}" if report.error else ""),
+        )
+    with open(
+        os.path.join(args.data_dir, f"delivery-report-{args.category}.json"), "w"
+    ) as reportfile:
+        reportfile.write(
+            json.dumps([report.model_dump() for report in reports], indent=2)
+        )
@@ -1,138 +1,293 @@
+import heapq
 import io
 import os
-import re
 import shutil
 import tempfile
 import textwrap
+import time
 import urllib
 import urllib.request
+from contextlib import closing
 from datetime import datetime, timedelta
 from logging import Logger
 from pprint import pformat
-from typing import Any, Optional, cast
+from typing import Any, Final, Iterable, Iterator, Optional
 
 import fitz
-from arxiv import Client, Result, Search, SortCriterion
-from langchain_core.language_models.base import LanguageModelInput
-from langchain_core.messages.ai import AIMessage
+from arxiv import Client, Search, SortCriterion
+from langchain_core.messages.ai import AIMessage, AIMessageChunk
+from langchain_core.messages.base import BaseMessage
 from langchain_core.messages.human import HumanMessage
-from langchain_core.runnables.base import Runnable
+from langchain_core.messages.system import SystemMessage
 from langchain_ollama import ChatOllama
 from langgraph.graph.graph import CompiledGraph
 from PIL import Image
 
-from const import Paper, PaperGist, PaperList
+from const import Paper, PaperCandidate, PaperGist, PaperList
+from llms import FormatterWithRecovery, ReasoningFilter
 
 
-def fetch_papers(
-    category: str, date: datetime, max_papers: int, logger: Logger
-) -> list[Result]:
-    client = Client(page_size=80)
+def iter_candidates(
+    category: str, since: datetime, until: datetime
+) -> Iterator[PaperCandidate]:
+    """Stream papers of the category published in [since, until) as slim records.
+
+    The window is part of the query, so that pages of papers newer than it are not
+    fetched at all. Results come sorted by submission date in descending order, so
+    paging also stops as soon as a paper older than the window shows up.
+    """
+    client = Client(page_size=100)
     search = Search(
-        query=f"cat:{category}",
-        max_results=80,  # get a large number of papers first
+        # the range in the query is inclusive on both ends, with minute precision
+        query=f"cat:{category} AND submittedDate:[{since.strftime('%Y%m%d%H%M')} TO {(until - timedelta(minutes=1)).strftime('%Y%m%d%H%M')}]",
+        max_results=None,  # pages are fetched lazily until the window is passed
         sort_by=SortCriterion.SubmittedDate,
     )
-    all_results = list(client.results(search=search))
-    selected = [
-        r for r in all_results if date <= r.published < (date + timedelta(days=1))
+    for result in client.results(search=search):
+        if result.published < since:
+            break
+        if result.published >= until:
+            continue
+        yield PaperCandidate(
+            title=result.title,
+            abstract=result.summary,
+            author=", ".join(
+                author.name for author in result.authors
+            ),  # generate comma-separated list of authors
+            url=result.entry_id,
+            pdf_url=result.pdf_url,
+            journal_ref=result.journal_ref,
+            published=result.published,
+        )
+
+
+def fetch_papers(
+    category: str, date: datetime, max_papers: int, logger: Logger
+) -> list[PaperCandidate]:
+    num_found = 0
+
+    def count(candidates: Iterable[PaperCandidate]) -> Iterator[PaperCandidate]:
+        nonlocal num_found
+        for candidate in candidates:
+            num_found += 1
+            yield candidate
+
+    # only max_papers candidates are kept at a time. like a stable sort, ties keep the newest first
+    selected = heapq.nlargest(
+        max_papers,
+        count(
+            iter_candidates(
+                category=category, since=date, until=date + timedelta(days=1)
+            )
+        ),
+        key=lambda x: len(str(x.journal_ref)),
+    )  # prioritize papers already published in a journal
+    logger.info(f"found {num_found} papers published on {date.strftime('%Y-%m-%d')}")
+    return selected
+
+
+# Prompts are laid out as a fixed system message followed by a per-paper user message,
+# so that Ollama can reuse the KV cache of the shared prefix from one paper to the next.
+SUMMARIZER_SYSTEM_PROMPT: Final[str] = textwrap.dedent("""\
+    You are a renowned professor in Computer Science. \
+    Your lab student, who is well versed in various Computer Science fields, will show you an academic paper and ask you to write a concise summary about it utilizing your expertise.
+
+    Your summary can be written in a free format, but should answer questions below:
+    - [About] What did this research do?
+    - [Objective] What did this research tried to achieve?
+    - [Novelty] How is this research superior to existing ones?
+    - [Key] What are the most important findings of this research?""")
+
+SUMMARIZER_AGENT_SYSTEM_PROMPT: Final[str] = (
+    # here, the LLM is equipped with web search tools. So adding a short instruction about them.
+    SUMMARIZER_SYSTEM_PROMPT  #                   NOTE: is this specification in paren necessary?  vvvvvvvvvvvvvvvvvvvvvvvvvvvv
+    + "\n\nYou can use tools given to you to obtain additional information about unfamiliar "  # (even to CS graduate students) "
+    + "notions and keywords that appear in the abstract. Whether to use tools is up to you, but if you decide to use them, they MUST be used BEFORE you start to write the summary. "
+    + "Additionally, when you actually used tools to obtain information about a keyword from a Web article which turned out to be ACTUALLY INDISPENSIBLE to understand the research paper, "
+    + "write its URL and title (that come as part of tools' responses) in the reference section at the bottom of the final summary. The reference section should ONLY exist when actual tool calls are made. The reference section should ONLY include urls that were really helpful, and shouldn't include random articles merely sharing similar concepts. "
+    + "Moreover, please don't include any URLs of the paper itself, arxiv.org, www.mdpi.com, or placeholder URLs like example.com, which are not real URLs, in ANY of your outputs."
+)
+
+FORMATTER_SYSTEM_PROMPT: Final[str] = textwrap.dedent("""\
+    Format the summary of an academic paper in Computer Science given by the user into the specified format.
+
+    [Format Instructions]
+    - Each point should be around 50 words, and no newline character may be included.
+    - When you want to emphasize words, be sure to surround them with **double asterisks at each end**, not a single asterisk.""")
+
+
+def build_summarizer_messages(
+    title: str, abstract: str, summarizer_as_agent: bool
+) -> list[BaseMessage]:
+    return [
+        SystemMessage(
+            SUMMARIZER_AGENT_SYSTEM_PROMPT
+            if summarizer_as_agent
+            else SUMMARIZER_SYSTEM_PROMPT
+        ),
+        HumanMessage(
+            textwrap.dedent(f"""\
+                ```
+                [Paper Information]
+                title: {title}
+                abstract: {abstract}
+                ```""")
+        ),
     ]
+
+
+def build_formatter_messages(summary: str) -> list[BaseMessage]:
+    return [
+        SystemMessage(FORMATTER_SYSTEM_PROMPT),
+        HumanMessage(f"[Paper Summary]\n{summary}"),
+    ]
+
+
+SUMMARIZER_WRAP_UP_PROMPT: Final[str] = (
+    "You have run out of time to think. "
+    "Based on your reasoning so far, write the summary now without any further thinking."
+)
+
+
+def stream_summary(
+    summarizer: CompiledGraph | ChatOllama,
+    summarizer_input: dict[str, Any] | list[BaseMessage],
+    max_reasoning_tokens: int,
+    logger: Logger,
+) -> str:
+    """Stream the summarizer's output and return its final answer with reasoning stripped.
+
+    Reasoning tokens are dropped as they arrive (a streamed chunk from Ollama
+    corresponds to one token). When the reasoning goes beyond `max_reasoning_tokens`,
+    or is cut off by num_predict, generation is stopped and the LLM is asked to write
+    the answer from the reasoning so far. The agent's reasoning can't be cut short
+    in the middle of its steps, so in that case the paper is given up on instead.
+    """
+    started_at = time.perf_counter()
+    first_token_at: Optional[float] = None
+    reasoning_tokens = 0
+
+    def consume(chunks: Iterator[AIMessageChunk]) -> tuple[str, Optional[str]]:
+        """Return the answer, or the reasoning so far in place of it if the reasoning didn't finish."""
+        nonlocal first_token_at, reasoning_tokens
+        reasoning_filter = ReasoningFilter()
+        answer_parts: list[str] = []
+        reasoning_parts: list[str] = []
+        message_id: Optional[str] = None
+        # closing the stream makes Ollama stop generating when the budget is exceeded
+        with closing(chunks):  # type: ignore
+            for chunk in chunks:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    logger.info(
+                        f"received the first token after {first_token_at - started_at:.1f}s"
+                    )
+                if chunk.id != message_id:
+                    # the agent calls the LLM once per step, and only the last call yields the final answer
+                    message_id = chunk.id
+                    reasoning_filter = ReasoningFilter()
+                    answer_parts = []
+                    reasoning_parts = []
+                text = chunk.content if isinstance(chunk.content, str) else ""
+                was_reasoning = reasoning_filter.in_reasoning
+                answer_parts.append(reasoning_filter.feed(text))
+                if was_reasoning or reasoning_filter.in_reasoning:
+                    reasoning_tokens += 1
+                    reasoning_parts.append(text)
+                    if len(reasoning_parts) > max_reasoning_tokens:
+                        logger.info(
+                            f"summarizer exceeded the reasoning budget of {max_reasoning_tokens} tokens"
+                        )
+                        break
+        if reasoning_filter.in_reasoning:
+            return "", "".join(reasoning_parts).replace(ReasoningFilter.OPEN_TAG, "")
+        answer_parts.append(reasoning_filter.flush())
+        return "".join(answer_parts).strip(), None
+
+    if isinstance(summarizer, CompiledGraph):
+        # in "messages" mode, the agent yields tokens of every LLM call and every tool output.
+        # only tokens generated by the LLM node are relevant here
+        answer, unfinished_reasoning = consume(
+            chunk
+            for chunk, metadata in summarizer.stream(
+                input=summarizer_input, stream_mode="messages"
+            )
+            if isinstance(chunk, AIMessageChunk)
+            and metadata.get("langgraph_node") == "agent"  # type: ignore
+        )
+        if unfinished_reasoning is not None:
+            raise RuntimeError("summarizer agent didn't finish reasoning")
+    else:
+        answer, unfinished_reasoning = consume(
+            summarizer.stream(input=summarizer_input)  # type: ignore
+        )
+        if unfinished_reasoning is not None:
+            # end the reasoning here and ask for the answer based on it
+            logger.info(
+                "asking the summarizer for the answer based on its reasoning so far"
+            )
+            answer, unfinished_reasoning = consume(
+                summarizer.stream(
+                    input=[
+                        *summarizer_input,  # type: ignore
+                        AIMessage(unfinished_reasoning),
+                        HumanMessage(SUMMARIZER_WRAP_UP_PROMPT),
+                    ]
+                )  # type: ignore
+            )
+            if unfinished_reasoning is not None:
+                raise RuntimeError(
+                    "summarizer didn't finish reasoning even when asked for the answer"
+                )
+    if not answer:
+        raise RuntimeError("summarizer returned an empty summary")
+
     logger.info(
-        f"found {len(selected)} papers published on {date.strftime('%Y-%m-%d')}"
+        f"summarizer finished in {time.perf_counter() - started_at:.1f}s "
+        f"({reasoning_tokens} reasoning tokens dropped)"
     )
-    selected_sorted = sorted(
-        selected, key=lambda x: len(str(x.journal_ref)), reverse=True
-    )  # prioritize papers already published in a journal
-    return selected_sorted[:max_papers]
+    return answer
 
 
 def generate_gist(
     summarizer: CompiledGraph | ChatOllama,
-    formatter: Runnable[LanguageModelInput, PaperGist],
+    formatter: FormatterWithRecovery,
     title: str,
     abstract: str,
+    max_reasoning_tokens: int,
     logger: Logger,
 ) -> PaperGist:
-    summarizer_input_text = textwrap.dedent(f"""
-        You are a renowned professor in Computer Science. \
-        Your lab student, who is well versed in various Computer Science fields, asked you to write a concise summary about the following academic paper utilizing your expertise.
-
-        Your summary can be written in a free format, but should answer questions below:
-        - [About] What did this research do?
-        - [Objective] What did this research tried to achieve?
-        - [Novelty] How is this research superior to existing ones?
-        - [Key] What are the most important findings of this research?
-
-        ```
-        [Paper Information]
-        title: {title}
-        abstract: {abstract}
-        ```""")
-
+    summarizer_messages = build_summarizer_messages(
+        title=title,
+        abstract=abstract,
+        summarizer_as_agent=isinstance(summarizer, CompiledGraph),
+    )
     # input type is different depending on whether the summarizer is an agent or not
     if isinstance(summarizer, CompiledGraph):
-        summarizer_input_text = (
-            # here, the LLM is equipped with web search tools. So adding a short instruction about them.
-            summarizer_input_text  #                   NOTE: is this specification in paren necessary?  vvvvvvvvvvvvvvvvvvvvvvvvvvvv
-            + "\nYou can use tools given to you to obtain additional information about unfamiliar "  # (even to CS graduate students) "
-            + "notions and keywords that appear in the abstract. Whether to use tools is up to you, but if you decide to use them, they MUST be used BEFORE you start to write the summary. "
-            + "Additionally, when you actually used tools to obtain information about a keyword from a Web article which turned out to be ACTUALLY INDISPENSIBLE to understand the research paper, "
-            + "write its URL and title (that come as part of tools' responses) in the reference section at the bottom of the final summary. The reference section should ONLY exist when actual tool calls are made. The reference section should ONLY include urls that were really helpful, and shouldn't include random articles merely sharing similar concepts. "
-            + "Moreover, please don't include any URLs of the paper itself, arxiv.org, www.mdpi.com, or placeholder URLs like example.com, which are not real URLs, in ANY of your outputs."
-        )
-        summarizer_input = {"messages": [HumanMessage(summarizer_input_text)]}
+        summarizer_input = {"messages": summarizer_messages}
         summarizer_model_name = summarizer.get_name()
     else:
-        summarizer_input = [HumanMessage(summarizer_input_text)]
+        summarizer_input = summarizer_messages
         summarizer_model_name = summarizer.model
 
     logger.info(
         f'starting summary generation for "{title}" with {summarizer_model_name}'
     )
-    summarizer_output = cast(
-        # agent returns the state (dict[str, Any]), while simple LLM returns an AIMessage
-        dict[str, Any] | AIMessage,
-        summarizer.invoke(input=summarizer_input),  # type: ignore
-    )
-    logger.debug(
-        pformat(
-            object=summarizer_output.model_dump()
-            if isinstance(summarizer_output, AIMessage)
-            else {
-                **summarizer_output,
-                "messages": [m.model_dump() for m in summarizer_output["messages"]],
-            },
-            width=shutil.get_terminal_size().columns,
-        )
+    started_at = time.perf_counter()
+    summarizer_output_text = stream_summary(
+        summarizer=summarizer,
+        summarizer_input=summarizer_input,
+        max_reasoning_tokens=max_reasoning_tokens,
+        logger=logger,
     )
+    logger.debug(summarizer_output_text)
     logger.info(f'finished summary generation for "{title}"')
 
     logger.info("starting formatting into JSON")
     try:
-        # strip reasoning tokens first
-        summarizer_output_text = re.sub(
-            pattern=r"<think>.+?<\/think>",
-            repl="",
-            string=summarizer_output.content
-            if isinstance(summarizer_output, AIMessage)
-            else summarizer_output["messages"][-1].content,  # type: ignore
-            flags=re.DOTALL,
-        ).strip()
-        # then format the summary into a PaperGist instance
+        # format the summary into a PaperGist instance
         paper_gist = formatter.invoke(
-            input=[
-                HumanMessage(
-                    textwrap.dedent(f"""\
-                    Format the following summary of an academic paper in Computer Science into the specified format.
-
-                    [Format Instructions]
-                    - Each point should be around 50 words, and no newline character may be included.
-                    - When you want to emphasize words, be sure to surround them with **double asterisks at each end**, not a single asterisk.
-
-                    [Paper Summary]
-                    {summarizer_output_text}""")
-                )
-            ]
+            input=build_formatter_messages(summary=summarizer_output_text)
         )
         logger.debug(
             pformat(
@@ -140,6 +295,9 @@ def generate_gist(
             )
         )
         logger.info("finished formatting")
+        logger.info(
+            f'generated gist for "{title}" in {time.perf_counter() - started_at:.1f}s in total'
+        )
         return paper_gist
     except Exception as e:
         logger.error("failed to format the summary")
@@ -194,11 +352,12 @@ def get_first_figure(pdf_url: str, data_dir: str, logger: Logger) -> Optional[st
 
 
 def process_results(
-    search_results: list[Result],
+    search_results: list[PaperCandidate],
     date: datetime,
     summarizer: CompiledGraph | ChatOllama,
-    formatter: Runnable[LanguageModelInput, PaperGist],
+    formatter: FormatterWithRecovery,
     data_dir: str,
+    max_reasoning_tokens: int,
     logger: Logger,
 ) -> PaperList:
     papers = []
@@ -208,7 +367,8 @@ def process_results(
                 summarizer=summarizer,
                 formatter=formatter,
                 title=result.title,
-                abstract=result.summary,
+                abstract=result.abstract,
+                max_reasoning_tokens=max_reasoning_tokens,
                 logger=logger,
             )
         except Exception as e:
@@ -224,11 +384,9 @@ def process_results(
         )
         paper = Paper(
             title=result.title,
-            author=", ".join(
-                map(lambda author: author.name, result.authors)
-            ),  # generate comma-separated list of authors
+            author=result.author,
             gist=gist,
-            url=result.entry_id,
+            url=result.url,
             first_figure_path=first_figure_path,
         )
         papers.append(paper)